@@ -1,69 +1,184 @@
 #!/usr/bin/env python3
-import json
-import codecs
 import os.path
 import argparse
+import asyncio
 import sys
 import subprocess
 import datetime
+import re
+import shutil
+import hashlib
+import tempfile
 
-from typing import Dict, List, Union, Any, Optional
+from typing import Dict, List, NamedTuple, Tuple, Union, Any, Optional
+
+try:
+    # orjson parses straight from bytes and is considerably faster
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 VERSION = "1.0.0"
 
+# most encoders do not scale much beyond this many threads per process,
+# used to derive the default number of parallel batch encodes
+ENCODER_THREADS_PER_JOB = 4
+
+USERDATA_PATTERN = re.compile(r"\$\{([^}]+)\}")
+
+# escape : and , in values used in the vf command
+VF_ESCAPE_TABLE = str.maketrans({":": "\\:", ",": "\\,"})
+
+# sentinel for keys missing from the config
+MISSING = object()
+
+# bounding box of the predefined --scale standards
+SCALE_SIZES = {"1080p": (1920, 1080), "720p": (1280, 720)}
+
+# hardware decoding flags, placed before the input file
+# fmt: off
+HW_DECODE_FLAGS = {
+    "cuda": ("-hwaccel", "cuda"),
+    "vaapi": ("-vaapi_device", "/dev/dri/renderD128", "-hwaccel", "vaapi"),
+    "videotoolbox": ("-hwaccel", "videotoolbox"),
+}
+# fmt: on
+
+# hardware encoders replacing the software ones when --hw is used
+HW_ENCODERS = {
+    "cuda": {
+        "h264": "h264_nvenc",
+        "libx264": "h264_nvenc",
+        "hevc": "hevc_nvenc",
+        "libx265": "hevc_nvenc",
+    },
+    "vaapi": {
+        "h264": "h264_vaapi",
+        "libx264": "h264_vaapi",
+        "hevc": "hevc_vaapi",
+        "libx265": "hevc_vaapi",
+    },
+    "videotoolbox": {
+        "h264": "h264_videotoolbox",
+        "libx264": "h264_videotoolbox",
+        "hevc": "hevc_videotoolbox",
+        "libx265": "hevc_videotoolbox",
+    },
+}
+
+
+class OutputSpec(NamedTuple):
+    filepath: str
+    scale: str
+
 
 class Config:
     filepath: str
     data: Dict[str, dict]
+    lookup_cache: Dict[str, Any]
+    font_fragments: Dict[str, List[str]]
+    _ffprobe: Optional[str]
+    _ffmpeg: Optional[str]
 
     def __init__(self, filepath: str):
-        if not os.path.exists(filepath):
-            raise BitcException(f"Config file '{filepath}' does not exist")
-
         self.filepath = filepath
-        with codecs.open(filepath, "r", "utf-8") as f:
-            self.data = json.load(f)
+        self.lookup_cache = {}
+        try:
+            with open(filepath, "rb") as f:
+                self.data = json_loads(f.read())
+        except FileNotFoundError:
+            raise BitcException(f"Config file '{filepath}' does not exist") from None
+        except OSError as e:
+            raise BitcException(
+                f"Config file '{filepath}' could not be read: {e.strerror}"
+            ) from None
 
         self.init_fonts()
 
-        # _userdata is to be replaced when ${} is seen
-        self.data["_userdata"] = {}
+        self.reset_userdata()
+
+        # resolve executables once so missing ones fail before any work
+        self._ffprobe = self.resolve_executable("path.ffprobe", "ffprobe")
+        self._ffmpeg = self.resolve_executable("path.ffmpeg", "ffmpeg")
 
     def __getitem__(self, key: str):
         return self.data[key]
 
+    @property
+    def ffprobe(self) -> Optional[str]:
+        return self._ffprobe
+
+    @property
+    def ffmpeg(self) -> Optional[str]:
+        return self._ffmpeg
+
+    def resolve_executable(self, key: str, default: str) -> Optional[str]:
+        name = self.get(key, default)
+        if name is None:
+            return None
+
+        path = shutil.which(str(name))
+        if path is None:
+            raise BitcException(f"Executable '{name}' ({key}) could not be found")
+
+        return os.path.abspath(path)
+
     def get(self, key: str, default: Any = None) -> Optional[Any]:
+        try:
+            item = self.lookup_cache[key]
+        except KeyError:
+            item = self.lookup_cache[key] = self.lookup(key)
+
+        return default if item is MISSING else item
+
+    def lookup(self, key: str) -> Any:
         item = self.data
         for k in key.split("."):
-            if item is None or type(item) is not dict:
-                return default
-            item = item.get(k, default)
+            if type(item) is not dict or k not in item:
+                return MISSING
+            item = item[k]
 
         return item
 
+    def reset_userdata(self):
+        # _userdata is to be replaced when ${} is seen
+        self.data["_userdata"] = {}
+        self.lookup_cache.clear()
+
     def hydrate_userdata(self, data: Union[None, List[str], Dict[str, str]]):
         if data is None:
             return
 
-        if type(data) is list:
+        # cached lookups are stale once userdata changes
+        self.lookup_cache.clear()
+
+        userdata = self.data["_userdata"]
+
+        if isinstance(data, dict):
+            userdata.update(data)
+
+        elif isinstance(data, list):
             for item in data:
-                parts = item.split("=")
-                if len(parts) != 2:
+                # only split on the first =, values may contain it as well
+                key, sep, value = item.partition("=")
+                if not sep or key == "":
                     raise BitcException(f"Badly formatted data entry '{item}'")
 
-                self.data["_userdata"][parts[0]] = parts[1]
-
-        elif type(data) is dict:
-            self.data["_userdata"].update(data)
+                userdata[key] = value
 
     def init_fonts(self):
-        if "fonts" in self.data and "colors" in self.data:
-            for data in self.data["fonts"].values():
-                if (
-                    "fontcolor" in data
-                    and data["fontcolor"] in self.data["colors"].keys()
-                ):
-                    data["fontcolor"] = self.data["colors"][data["fontcolor"]]
+        fonts = self.data.get("fonts") or {}
+        colors = self.data.get("colors")
+        if colors:
+            for data in fonts.values():
+                color = data.get("fontcolor")
+                if color is not None and color in colors:
+                    data["fontcolor"] = colors[color]
+
+        # fonts are final from here on, prebuild their drawtext options
+        self.font_fragments = {
+            name: [f"{k}={v}" for k, v in data.items()] for name, data in fonts.items()
+        }
 
 
 def main() -> int:
@@ -71,13 +186,139 @@ def main() -> int:
     args = init_arg_parser().parse_args()
     config = Config(args.config)
 
-    input_filepath = os.path.abspath(args.i)
-    output_filepath = os.path.abspath(args.output)
+    if len(args.i) > 1 and any("{stem}" not in o for o in args.output):
+        raise BitcException(
+            "Output filename must contain '{stem}' when encoding multiple input files"
+        )
+
+    scales = args.scale or ["off"]
+    if len(scales) == 1:
+        scales = scales * len(args.output)
+    elif len(scales) != len(args.output):
+        raise BitcException("Specify either one --scale or one per output file")
+
+    inputs: List[Tuple[str, List[OutputSpec], os.stat_result]] = []
+    for filename in args.i:
+        input_filepath = os.path.abspath(filename)
+        try:
+            input_stat = os.stat(input_filepath)
+        except FileNotFoundError:
+            raise BitcException(
+                f"Input file '{input_filepath}' does not exist"
+            ) from None
+        except OSError as e:
+            raise BitcException(
+                f"Input file '{input_filepath}' could not be accessed: {e.strerror}"
+            ) from None
+
+        stem = os.path.splitext(os.path.basename(input_filepath))[0]
+        outputs = [
+            OutputSpec(os.path.abspath(output.replace("{stem}", stem)), scale)
+            for output, scale in zip(args.output, scales)
+        ]
+        inputs.append((input_filepath, outputs, input_stat))
+
+    output_filepaths = [o.filepath for _, outputs, _ in inputs for o in outputs]
+    if len(set(output_filepaths)) != len(output_filepaths):
+        raise BitcException("Multiple encodes would write to the same output file")
+
+    if len(inputs) > 1:
+        return asyncio.run(encode_batch(config, args, inputs))
+
+    input_filepath, outputs, input_stat = inputs[0]
+    metadata = probe_media(config, input_filepath, input_stat)
+    command = build_encode_command(config, args, input_filepath, outputs, metadata)
+
+    print("Encode starting...")
+    result = subprocess.run(command, stderr=subprocess.STDOUT)
+    if result.returncode == 0:
+        print(f"Encode succeeded, {describe_outputs(outputs)}")
+        return 0
+    else:
+        print("Encode FAILED!", file=sys.stderr)
+        return result.returncode
+
 
-    if not os.path.exists(input_filepath):
-        raise BitcException(f"Input file '{input_filepath}' does not exist")
+async def encode_batch(
+    config: Config,
+    args: argparse.Namespace,
+    inputs: List[Tuple[str, List[OutputSpec], os.stat_result]],
+) -> int:
+
+    jobs = args.jobs
+    if jobs is None:
+        jobs = max(1, (os.cpu_count() or 1) // ENCODER_THREADS_PER_JOB)
+
+        # consumer NVIDIA cards only allow a few concurrent NVENC sessions
+        if "nvenc" in resolve_video_codec(args):
+            jobs = min(jobs, 2)
+
+    # bounds both the probes and the encodes, so a batch of hundreds of files
+    # never spawns more than that many processes at once
+    semaphore = asyncio.Semaphore(jobs)
+
+    async def probe(filepath: str, stat: os.stat_result) -> Dict[str, Any]:
+        async with semaphore:
+            return await probe_media_async(config, filepath, stat)
+
+    metadatas = await asyncio.gather(
+        *(probe(filepath, stat) for filepath, _, stat in inputs)
+    )
+
+    # commands are built one after another as they share the config userdata,
+    # progress stats of concurrent encodes would overwrite each other
+    commands = [
+        build_encode_command(
+            config, args, input_filepath, outputs, metadata, stats=jobs == 1
+        )
+        for (input_filepath, outputs, _), metadata in zip(inputs, metadatas)
+    ]
+
+    async def encode(
+        command: List[str], input_filepath: str, outputs: List[OutputSpec]
+    ) -> int:
+        async with semaphore:
+            print(f"Encode starting for '{input_filepath}'...")
+            # stdin is shared by all jobs, never let ffmpeg prompt on it
+            proc = await asyncio.create_subprocess_exec(
+                *command,
+                stdin=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.STDOUT,
+            )
+            returncode = await proc.wait()
+
+        if returncode == 0:
+            print(f"Encode succeeded, {describe_outputs(outputs)}")
+        else:
+            print(f"Encode FAILED for '{input_filepath}'!", file=sys.stderr)
+
+        return returncode
+
+    print(f"Encoding {len(commands)} files, {jobs} at a time...")
+    results = await asyncio.gather(
+        *(
+            encode(command, input_filepath, outputs)
+            for command, (input_filepath, outputs, _) in zip(commands, inputs)
+        )
+    )
+
+    failed = [returncode for returncode in results if returncode != 0]
+    if len(failed) > 0:
+        print(f"{len(failed)} of {len(results)} encodes FAILED!", file=sys.stderr)
+        return failed[0]
+
+    return 0
+
+
+def build_encode_command(
+    config: Config,
+    args: argparse.Namespace,
+    input_filepath: str,
+    outputs: List[OutputSpec],
+    metadata: Dict[str, Any],
+    stats: bool = True,
+) -> List[str]:
 
-    metadata = probe_media(config, input_filepath)
     format = metadata["format"]
 
     video_stream: Optional[dict] = None
@@ -87,63 +328,93 @@ def main() -> int:
     # select first stream
     # TODO: Add option to select stream from media file
     for stream in metadata.get("streams", []):
-        if video_stream is None and stream["codec_type"] == "video":
+        codec_type = stream["codec_type"]
+
+        if video_stream is None and codec_type == "video":
             video_stream = stream
-            continue
 
-        if audio_stream is None and stream["codec_type"] == "audio":
+        elif audio_stream is None and codec_type == "audio":
             audio_stream = stream
-            continue
 
-        if (
+        elif (
             embedded_timecode is None
-            and stream["codec_type"] == "data"
+            and codec_type == "data"
             and stream.get("codec_tag_string", "") == "tmcd"
         ):
             embedded_timecode = stream
+
+        else:
             continue
 
+        # stop scanning once everything has been found
+        if (
+            video_stream is not None
+            and audio_stream is not None
+            and embedded_timecode is not None
+        ):
+            break
+
     if video_stream is None:
         raise BitcException(
             f"Input file '{input_filepath}' does not have any video streams"
         )
 
-    # hydrate from metadata first
-    config.hydrate_userdata(
-        build_userdata_from_metadata(
-            os.path.basename(output_filepath), video_stream, audio_stream, format
+    timecode_userdata = extract_embedded_timecode_start(embedded_timecode)
+
+    # every output gets its own overlay, e.g. the heading shows its filename
+    overlays = []
+    for output in outputs:
+        config.reset_userdata()
+
+        # hydrate from metadata first
+        config.hydrate_userdata(
+            build_userdata_from_metadata(
+                os.path.basename(output.filepath), video_stream, audio_stream, format
+            )
         )
-    )
 
-    # hydrate embedded timecode
-    config.hydrate_userdata(extract_embedded_timecode_start(embedded_timecode))
+        # hydrate embedded timecode
+        config.hydrate_userdata(timecode_userdata)
+
+        # then hydrate from user provided data arg
+        config.hydrate_userdata(args.data)
 
-    # then hydrate from user provided data arg
-    config.hydrate_userdata(args.data)
+        overlays.append(
+            build_overlay_filter(args.preset, config, args.data, video_stream, format)
+        )
 
     command = build_ffmpeg_command(
         config,
         args,
         input_filepath,
-        output_filepath,
+        outputs,
+        overlays,
         video_stream,
         audio_stream,
         format,
+        stats,
     )
 
     if command is None:
         raise BitcException("There was an error while generating the encode command")
 
-    print("Encode starting...")
-    result = subprocess.run(command, stderr=subprocess.STDOUT)
-    if result.returncode == 0:
-        print(
-            f"Encode succeeded, your new file has been created at '{output_filepath}'"
-        )
-        return 0
-    else:
-        print("Encode FAILED!", file=sys.stderr)
-        return result.returncode
+    return command
+
+
+def describe_outputs(outputs: List[OutputSpec]) -> str:
+    if len(outputs) == 1:
+        return f"your new file has been created at '{outputs[0].filepath}'"
+
+    filepaths = ", ".join(f"'{o.filepath}'" for o in outputs)
+    return f"your new files have been created at {filepaths}"
+
+
+def positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+
+    return number
 
 
 def init_arg_parser() -> argparse.ArgumentParser:
@@ -152,7 +423,18 @@ def init_arg_parser() -> argparse.ArgumentParser:
     )
 
     parser.add_argument(
-        "-i", type=str, metavar="FILENAME", help="input filename", required=True
+        "-i",
+        type=str,
+        metavar="FILENAME",
+        action="append",
+        help="input filename, repeat to encode multiple files in parallel",
+        required=True,
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=positive_int,
+        help="number of parallel encodes for multiple input files (default: auto)",
     )
 
     parser.add_argument(
@@ -171,11 +453,18 @@ def init_arg_parser() -> argparse.ArgumentParser:
         "-vb", "--bitrate", help="output video bitrate (default: auto)", default="auto"
     )
     parser.add_argument("-vp", "--profile", help="output video profile")
+    parser.add_argument(
+        "--hw",
+        choices=tuple(HW_DECODE_FLAGS),
+        help="use hardware decoding, h264/hevc codecs are replaced with "
+        + "the matching hardware encoder (default: off)",
+    )
     parser.add_argument(
         "--scale",
-        choices=("off", "1080p", "720p"),
-        default="off",
-        help="scale the video to one of the predefined standard (default: off)",
+        choices=("off", *SCALE_SIZES),
+        action="append",
+        help="scale the video to one of the predefined standard, "
+        + "repeat to set it per output file (default: off)",
     )
 
     parser.add_argument(
@@ -192,7 +481,10 @@ def init_arg_parser() -> argparse.ArgumentParser:
     )
 
     parser.add_argument(
-        "-d", "--data", help="custom user data in KEY=VALUE format", nargs="+"
+        "-d",
+        "--data",
+        help="custom user data in KEY=VALUE format (the value may contain '=')",
+        nargs="+",
     )
     parser.add_argument("--flags", nargs="+", help="additional ffmpeg flags")
 
@@ -212,32 +504,101 @@ def init_arg_parser() -> argparse.ArgumentParser:
         help="override existing file check, will replace output file without asking!",
     )
 
-    parser.add_argument("output", help="output filename")
+    parser.add_argument(
+        "output",
+        nargs="+",
+        help="output filename(s), multiple outputs share a single decode of the "
+        + "input, {stem} is replaced with the input filename without extension "
+        + "(required for multiple input files)",
+    )
 
     return parser
 
 
-def probe_media(config: Config, filename: str) -> Dict[str, Any]:
-    ffprobe = config.get("path.ffprobe", "ffprobe")
+def probe_media(
+    config: Config, filename: str, stat: Optional[os.stat_result] = None
+) -> Dict[str, Any]:
+    return asyncio.run(probe_media_async(config, filename, stat))
+
+
+async def probe_media_async(
+    config: Config, filename: str, stat: Optional[os.stat_result] = None
+) -> Dict[str, Any]:
+    ffprobe = config.ffprobe
     if ffprobe is None:
         return {}
 
+    if config.get("cache.probe", True):
+        return await _cached_probe(ffprobe, filename, stat or os.stat(filename))
+
+    return json_loads(await _run_ffprobe(ffprobe, filename))
+
+
+async def _run_ffprobe(ffprobe: str, filename: str) -> bytes:
+    # Keep this launch eligible for the posix_spawn fast path of subprocess:
+    # pipes/devnull only and close_fds off (our own fds are non-inheritable)
     # fmt: off
-    result = subprocess.run(
-        [
-            str(ffprobe),
-            "-hide_banner",
-            "-show_format",
-            "-show_streams",
-            "-of", "json",
-            "-loglevel", "quiet",
-            filename,
-        ],
-        stdout=subprocess.PIPE,
+    proc = await asyncio.create_subprocess_exec(
+        ffprobe,
+        "-hide_banner",
+        "-show_format",
+        "-show_streams",
+        "-of", "json",
+        "-loglevel", "quiet",
+        filename,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL,
+        close_fds=False,
     )
     # fmt: on
 
-    return json.loads(result.stdout)
+    stdout, _ = await proc.communicate()
+    return stdout
+
+
+def _probe_cache_dir() -> str:
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache_home, "fluxbitc", "probe")
+
+
+async def _cached_probe(ffprobe: str, path: str, st: os.stat_result) -> Dict[str, Any]:
+    # cache is keyed on the file identity and the ffprobe build, a modified
+    # file or a different/upgraded ffprobe gets probed again
+    ffprobe_mtime_ns = os.stat(ffprobe).st_mtime_ns
+    key = hashlib.blake2b(
+        f"{path}|{st.st_mtime_ns}|{st.st_size}|{ffprobe}|{ffprobe_mtime_ns}".encode(),
+        digest_size=16,
+    ).hexdigest()
+
+    cache_dir = _probe_cache_dir()
+    cache_filepath = os.path.join(cache_dir, key + ".json")
+
+    try:
+        with open(cache_filepath, "rb") as f:
+            return json_loads(f.read())
+    except (OSError, ValueError):
+        pass
+
+    output = await _run_ffprobe(ffprobe, path)
+    metadata = json_loads(output)
+
+    # only cache successful probes, write atomically so that concurrent runs
+    # never see a partially written file
+    if metadata.get("streams"):
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            fd, tmp_filepath = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(output)
+                os.replace(tmp_filepath, cache_filepath)
+            except OSError:
+                os.unlink(tmp_filepath)
+                raise
+        except OSError:
+            print("WARNING: Unable to write the probe cache", file=sys.stderr)
+
+    return metadata
 
 
 def build_userdata_from_metadata(
@@ -251,18 +612,15 @@ def build_userdata_from_metadata(
     if fps_rate != video_stream["avg_frame_rate"]:
         raise BitcException("Variable framerate video streams are not supported")
 
-    timestamp = datetime.datetime.utcnow().isoformat()
+    timestamp = datetime.datetime.now(datetime.timezone.utc).strftime(
+        "%Y-%m-%dT%H:%M:%SZ"
+    )
 
-    fps = fps_rate
-    if "/" in fps:
-        fps_n, fps_d = fps.split("/")
-        if fps_d == "1":
-            fps = int(fps_n)
-        else:
-            fps = float(fps_n) / float(fps_d)
-            fps = round(fps, 3)
+    fps_n, sep, fps_d = fps_rate.partition("/")
+    if not sep or fps_d == "1":
+        fps = int(fps_n)
     else:
-        fps = int(fps)
+        fps = round(int(fps_n) / int(fps_d), 3)
 
     info_1 = f"{video_stream['width']}x{video_stream['height']}, {fps} FPS"
 
@@ -277,7 +635,7 @@ def build_userdata_from_metadata(
         "timecode_start": "01:00:00:00",
         "fps_rate": fps_rate,
         "heading_title": output_filename,
-        "heading_sub": timestamp.split(".")[0] + "Z",
+        "heading_sub": timestamp,
         "info_1": info_1,
         "info_2": info_2,
     }
@@ -314,78 +672,150 @@ def build_ffmpeg_command(
     config: Config,
     args: argparse.Namespace,
     input_filepath: str,
-    output_filepath: str,
+    outputs: List[OutputSpec],
+    overlays: List[str],
     video_stream: Dict[str, Any],
     audio_stream: Optional[Dict[str, Any]],
     format_metadata: Dict[str, Any],
+    stats: bool = True,
 ) -> Optional[List[str]]:
 
-    ffmpeg = config.get("path.ffmpeg", "ffmpeg")
+    ffmpeg = config.ffmpeg
     if ffmpeg is None:
         return None
 
-    cmd = [ffmpeg, "-hide_banner", "-loglevel", "warning", "-stats"]
+    cmd = [ffmpeg, "-hide_banner", "-loglevel", "warning"]
+    cmd.append("-stats" if stats else "-nostats")
+
+    # hardware decoding, frames come back to system memory for the overlay
+    if args.hw is not None:
+        cmd.extend(HW_DECODE_FLAGS[args.hw])
 
     # input file
-    cmd += ["-i", input_filepath]
+    cmd.extend(("-i", input_filepath))
 
-    # video stream processing
-    cmd += ["-map", f"0:{video_stream['index']}"]
-    cmd += ["-c:v", args.codec]
+    # override output check
+    if args.y is True:
+        cmd.append("-y")
 
-    if not args.bitrate == "auto":
-        cmd += ["-b:v", args.bitrate]
+    video_input = f"0:{video_stream['index']}"
+    video_codec = resolve_video_codec(args)
 
-    if args.profile is not None:
-        cmd += ["-profile:v", args.profile]
+    # video filters of every output
+    filters = []
+    for output, overlay in zip(outputs, overlays):
+        pre, post = build_scale_filter(output.scale, args.hw, video_codec)
 
-    # TODO: add scaling filters
-    if args.scale != "off":
-        raise BitcException("Scaling feature is not yet implemented")
+        # an empty preset leaves nothing to do, null keeps the chain valid
+        chain = ",".join(f for f in (pre, overlay, post) if f)
+        filters.append(chain or "null")
 
-    cmd += build_overlay_flags(
-        args.preset, config, args.data, video_stream, format_metadata
-    )
+    # multiple outputs: decode the source once and split it into every output
+    if len(outputs) > 1:
+        split = f"[{video_input}]split={len(outputs)}"
+        split += "".join(f"[s{i}]" for i in range(len(outputs)))
 
-    # audio stream processing
-    if args.audio_codec != "off" and audio_stream is not None:
-        cmd += ["-map", f"0:{audio_stream['index']}"]
-        if args.audio_codec != "auto":
-            cmd += ["-c:a", args.audio_codec]
+        graph = [split]
+        graph.extend(f"[s{i}]{chain}[v{i}]" for i, chain in enumerate(filters))
+        cmd.extend(("-filter_complex", ";".join(graph)))
 
-        if args.audio_bitrate != "auto":
-            cmd += ["-b:a", args.audio_bitrate]
+    for i, output in enumerate(outputs):
+        # video stream processing
+        if len(outputs) > 1:
+            cmd.extend(("-map", f"[v{i}]"))
+        else:
+            cmd.extend(("-map", video_input, "-vf", filters[i]))
 
-    else:
-        cmd.append("-an")
+        cmd.extend(("-c:v", video_codec))
 
-    # additional flags
-    if args.flags is not None:
-        cmd += " ".join(args.flags).split(" ")
+        if not args.bitrate == "auto":
+            cmd.extend(("-b:v", args.bitrate))
 
-    # container format
-    if args.container != "auto":
-        cmd += ["-f", args.container]
+        if args.profile is not None:
+            cmd.extend(("-profile:v", args.profile))
 
-    # override output check
-    if args.y is True:
-        cmd.append("-y")
+        # audio stream processing
+        if args.audio_codec != "off" and audio_stream is not None:
+            cmd.extend(("-map", f"0:{audio_stream['index']}"))
+            if args.audio_codec != "auto":
+                cmd.extend(("-c:a", args.audio_codec))
+
+            if args.audio_bitrate != "auto":
+                cmd.extend(("-b:a", args.audio_bitrate))
+
+        else:
+            cmd.append("-an")
 
-    # output file
-    cmd.append(output_filepath)
+        # additional flags
+        if args.flags is not None:
+            cmd.extend(" ".join(args.flags).split(" "))
+
+        # container format
+        if args.container != "auto":
+            cmd.extend(("-f", args.container))
+
+        # output file
+        cmd.append(output.filepath)
 
     return cmd
 
 
-def build_overlay_flags(
+def resolve_video_codec(args: argparse.Namespace) -> str:
+    if args.hw is None:
+        return args.codec
+
+    return HW_ENCODERS[args.hw].get(args.codec, args.codec)
+
+
+def build_scale_filter(
+    scale: str, hw: Optional[str] = None, video_codec: str = ""
+) -> Tuple[Optional[str], Optional[str]]:
+    # returns the filters to run before and after the overlay
+    if scale != "off" and scale not in SCALE_SIZES:
+        raise BitcException(f"Unknown scale '{scale}'")
+
+    # fit inside the standard frame size, keeping the aspect ratio, with even
+    # dimensions as required by nv12 and most encoders
+    size = ""
+    if scale != "off":
+        width, height = SCALE_SIZES[scale]
+        size = (
+            f"w={width}:h={height}"
+            + ":force_original_aspect_ratio=decrease:force_divisible_by=2"
+        )
+
+    # Exception to scaling before the overlay: drawtext only runs on the cpu,
+    # so frames scaled and encoded on the gpu are uploaded after the overlay
+    if hw == "cuda" and video_codec.endswith("_nvenc"):
+        # nvenc uploads frames by itself when they are not scaled
+        if size == "":
+            return None, None
+
+        return None, f"hwupload_cuda,scale_npp={size}:format=nv12:interp_algo=lanczos"
+
+    if hw == "vaapi" and video_codec.endswith("_vaapi"):
+        # vaapi encoders only accept frames in gpu memory
+        if size == "":
+            return None, "format=nv12,hwupload"
+
+        return None, f"format=nv12,hwupload,scale_vaapi={size}"
+
+    if size == "":
+        return None, None
+
+    # scale first so the overlay keeps its pixel size on the output
+    return f"scale={size}", None
+
+
+def build_overlay_filter(
     preset_name: str,
     config: Config,
     data: List[str],
     video_stream: Dict[str, Any],
     format_metadata: Dict[str, Any],
-) -> List[str]:
+) -> str:
 
-    if preset_name not in config.get("presets", {}).keys():
+    if preset_name not in config.get("presets", {}):
         raise BitcException(
             f"Definition of preset '{preset_name}' does not exist in the config file"
         )
@@ -393,13 +823,17 @@ def build_overlay_flags(
     preset = config["presets"][preset_name]
     drawtexts = []
 
-    if "items" not in preset.keys():
+    if "items" not in preset:
         raise BitcException(
             f"Definition of preset '{preset_name}' does not have the `items` key"
         )
 
     userdata = config.get("_userdata", {})
-    fonts = config.get("fonts", {})
+    font_fragments = config.font_fragments
+
+    def replace_userdata(match: "re.Match") -> str:
+        # leave unknown placeholders untouched
+        return userdata.get(match.group(1), match.group(0))
 
     for item in preset["items"]:
         filters = []
@@ -407,21 +841,14 @@ def build_overlay_flags(
             value = str(value)
 
             if key == "font":
-                if value in fonts.keys():
-                    for fk, fv in fonts[value].items():
-                        filters.append(f"{fk}={fv}")
+                if value in font_fragments:
+                    filters.extend(font_fragments[value])
 
             # Replace ${} with userdata
             if "${" in value:
-                # TODO: This is very inefficient when userdata is large, fix this!
-                for uk, uv in userdata.items():
-                    target = "${" + uk + "}"
-                    if target in value:
-                        value = value.replace(target, uv)
+                value = USERDATA_PATTERN.sub(replace_userdata, value)
 
-            # escape : and , in value in vf command
-            value = value.replace(":", "\\:")
-            value = value.replace(",", "\\,")
+            value = value.translate(VF_ESCAPE_TABLE)
 
             if key == "text" or key == "timecode":
                 filters.append(f"{key}='{value}'")
@@ -430,7 +857,7 @@ def build_overlay_flags(
 
         drawtexts.append(":".join(filters))
 
-    return ["-vf", ",".join([f"drawtext={c}" for c in drawtexts])]
+    return ",".join(f"drawtext={c}" for c in drawtexts)
 
 
 class BitcException(Exception):